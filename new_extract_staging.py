@@ -16,6 +16,14 @@ of LLM calls needed. The script automatically checks if the concatenated text fi
 within the model's context window, and falls back to processing notes individually
 if it doesn't.
 
+Before any LLM call, a regex pre-filter finds candidate TNM/stage mentions in each
+note. Only short windows around those mentions are sent to the LLM, and patients
+with no candidate mentions are skipped entirely (disable with --no-prefilter).
+
+When vLLM is installed, all patient prompts in a file are submitted to a vLLM engine
+in a single call so they are scheduled together with continuous batching. Without
+vLLM the script falls back to Hugging Face transformers.
+
 Usage:
     # First activate the virtual environment:
     source /wynton/protected/home/zack/brtan/Virtual_Environments/dask_distribution_env/bin/activate
@@ -23,6 +31,14 @@ Usage:
     # Then run the script with patient-based batching (default):
     python new_extract_staging.py <batch_number>
     
+    # Process several batches (or inclusive ranges) in one process, loading the model once:
+    python new_extract_staging.py <batch_number> <batch_number> ...
+    python new_extract_staging.py 0-99
+    
+    # Or start a vLLM server once (./run_vllm_server.sh) and process batches
+    # concurrently in worker processes that share it:
+    python new_extract_staging.py <batch_number> ... --server-url http://localhost:8000/v1
+    
     # To disable patient-based batching and process each note individually:
     python new_extract_staging.py <batch_number> --no-patient-batching
     
@@ -31,21 +47,33 @@ Usage:
     
     # For benchmarking the parsing performance:
     python new_extract_staging.py --benchmark
+    
+    # One-time setup: quantize the model to INT4 AWQ (saved next to the model as <model>-awq):
+    python new_extract_staging.py --quantize
 """
 
 import os
+import sys
 import glob
 import pandas as pd
 import numpy as np
 from pathlib import Path
-from typing import List, Dict, Optional, Union
+from typing import List, Dict, Optional, Union, Iterator, Tuple
 import time
 import logging
 import argparse
-from tqdm import tqdm
 import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+import pyarrow.csv as pacsv
 import pyarrow as pa
 import re
+import hashlib
+import pickle
+import fcntl
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
 # Try to load dotenv if available, but continue if not
 try:
@@ -62,6 +90,30 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Columns read from the filtered note batches for extraction; the pass that
+# writes results reads every column so the output stays linkable
+INPUT_COLUMNS = ["patientdurablekey", "note_text"]
+
+# Rows per record batch when streaming parquet files
+STREAM_BATCH_SIZE = 4096
+
+# Prompt template for staging extraction - adapted for Llama-3.1-8B.
+# The note text goes between the prefix and the suffix.
+PROMPT_PREFIX = """<|system|>
+You are a medical assistant that extracts cancer staging information from clinical notes.
+<|user|>
+Analyze this clinical note and extract cancer staging information:
+
+"""
+
+PROMPT_SUFFIX = """
+
+Respond with EXACTLY ONE of these formats (no additional text):
+1. "NA" if no staging information exists
+2. "Stage: [stage]" for general staging (e.g., "Stage: IIB") 
+3. "TNM: [classification]" for TNM classifications (e.g., "TNM: T2N1M0")
+<|assistant|>"""
+
 class StagingExtractor:
     """Class to extract staging information from clinical notes using LLM."""
     
@@ -69,38 +121,169 @@ class StagingExtractor:
         """Initialize the staging extractor."""
         self.llm_model = None
         self.tokenizer = None
+        self.backend = None  # "vllm", "transformers" or "server", set when the model is loaded
+        # OpenAI-compatible vLLM server (e.g. "http://localhost:8000/v1"); when set, no
+        # model is loaded in this process and prompts are sent to the server instead
+        self.server_url = None
+        self.server_model = "llama-3.1-8b"  # --served-model-name of the server
+        # Maximum in-flight requests from this process; across all client processes
+        # this should stay near the server's --max-num-seqs so requests don't queue
+        self.server_concurrency = 256
+        self.server_timeout = 600.0  # Seconds
+        self._template_prefix_ids = None
+        self._template_suffix_ids = None
+        self._template_token_count = 0
+        # Parsed LLM results keyed by a hash of the note text, so duplicate
+        # texts (within a file or across runs) only go through the LLM once
+        self.response_cache: Dict[bytes, Dict[str, Optional[str]]] = {}
+        # Hash of the model and settings responses depend on, mixed into every
+        # cache key (set in _load_llm once the backend and weights are known)
+        self._cache_fingerprint = b""
         # Path to local model
         self.model_path = "/wynton/protected/home/zack/brtan/models/Llama-3.1-8B"
+        # INT4 AWQ checkpoint produced by quantize_model(); used on GPU when present
+        self.quantized_model_path = self.model_path + "-awq"
+        self.use_quantized = True
         # Approximate token count for context window estimation
         self.max_context_length = 8192  # Llama-3.1-8B context window
         self.avg_chars_per_token = 3.5  # Approximate for English text
+        self.max_new_tokens = 32  # Responses are a single short line ("NA", "Stage: IIB", ...)
+        self.generation_token_budget = 16384  # Padded prompt tokens per generate call (transformers backend)
+        # transformers backend on GPU: static KV cache + torch.compile'd forward. Prompts are
+        # padded to fixed length buckets so compiled graphs are reused across batches.
+        self.compile_model = False
+        self.length_buckets = [256, 512, 1024, 2048, 4096, 8192]
+        # Regex pre-filter: only context windows around candidate staging mentions
+        # are sent to the LLM, and notes without any candidate are skipped
+        self.use_prefilter = True
+        self.prefilter_window = 200  # Characters of context on each side of a match
+        self.max_window_chars = 4000  # Note text kept for texts that exceed the context window
+        # c/p/y/r prefixes and suffixes such as "mi", "(m)", "(sn)", "(i+)" on each component,
+        # optionally separated by spaces, commas or slashes; M is often omitted in pathology reports
+        tnm_suffix = r"(?:mi|\((?:m|sn|i[+-]|mol[+-]|\d+)\))?"
+        self._tnm_re = re.compile(
+            r"\b[cpry]{0,2}T(?:[0-4X]|is)[a-d]?" + tnm_suffix
+            + r"[\s,/]*[cpry]{0,2}N[0-3X][a-c]?" + tnm_suffix
+            + r"(?:[\s,/]*[cpry]{0,2}M[01X][a-c]?" + tnm_suffix + r")?(?!\w)",
+            re.I,
+        )
+        # "Stage IIB", "Stage: IIB", "Stage:IIIA", "stage group IIB", "pStage IIA", FIGO "stage IIIC1"
+        self._stage_re = re.compile(
+            r"\b[cpry]{0,2}Stage(?:\s+group)?[:\s]+(?:IV|III|II|I|0|[1-4])[A-C]?[1-3]?\b", re.I
+        )
+        # End of a labelled value in an LLM response ("Stage: IIB, TNM: T2N1M0"): the next
+        # label, a comma/semicolon or a sentence end (the line end is handled separately)
+        self._value_end_re = re.compile(r"[,;]|\.(?:\s|$)|TNM:|Stage:")
         
-    def _estimate_token_count(self, text: str) -> int:
+    def _staging_spans(self, text: str, window: int) -> List[List[int]]:
         """
-        Estimate the number of tokens in a text without loading the tokenizer.
-        This is a fast approximation to check if we should even attempt to load the model.
+        Find the character spans around candidate TNM/stage mentions in a note.
         
         Args:
-            text: The text to estimate token count for
+            text: The clinical note text
+            window: Characters of context to include on each side of a match
             
         Returns:
-            Estimated token count
+            Sorted, non-overlapping [start, end] spans (empty if there are no matches)
         """
-        # Simple character-based estimation
-        return int(len(text) / self.avg_chars_per_token)
+        spans = []
+        for pattern in (self._tnm_re, self._stage_re):
+            for match in pattern.finditer(text):
+                spans.append((max(0, match.start() - window), min(len(text), match.end() + window)))
+        
+        if not spans:
+            return []
+        
+        # Merge overlapping windows so no text is repeated
+        spans.sort()
+        merged = [list(spans[0])]
+        for start, end in spans[1:]:
+            if start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+    
+    def _extract_staging_windows(self, text: str) -> str:
+        """
+        Extract the context windows around candidate TNM/stage mentions in a note.
+        
+        Args:
+            text: The clinical note text
+            
+        Returns:
+            The merged windows joined with "..." separators, or an empty string
+            if the note contains no candidate staging mention
+        """
+        spans = self._staging_spans(text, self.prefilter_window)
+        return "\n...\n".join(text[start:end] for start, end in spans)
+    
+    def _extract_relevant_windows(self, text: str, max_chars: int = 4000) -> str:
+        """
+        Shorten a text that is too long for the context window.
+        
+        Keeps ±300 characters around candidate staging mentions, preferring the
+        latest mentions (discharge summaries often state staging at the end)
+        until max_chars is reached. Without any mention, keeps the head and tail.
+        
+        Args:
+            text: The text to shorten
+            max_chars: Maximum number of characters of note text to keep
+            
+        Returns:
+            The shortened text
+        """
+        spans = self._staging_spans(text, 300)
+        if not spans:
+            half = max_chars // 2
+            return text[:half] + "\n...\n" + text[-half:]
+        
+        kept = []
+        total = 0
+        for start, end in reversed(spans):
+            remaining = max_chars - total
+            if kept and end - start > remaining:
+                break
+            # A span longer than max_chars keeps its end, where the latest mention is
+            kept.append((max(start, end - remaining), end))
+            total += end - start
+        
+        return "\n...\n".join(text[start:end] for start, end in reversed(kept))
+    
+    def _prefilter_text(self, text) -> str:
+        """
+        Reduce a note to the text that should be sent to the LLM.
+        
+        Args:
+            text: The clinical note text (may be missing/non-string)
+            
+        Returns:
+            The staging windows if the pre-filter is enabled, otherwise the full
+            text; an empty string means the note can be skipped
+        """
+        if not isinstance(text, str) or not text.strip():
+            return ""
+        if not self.use_prefilter:
+            return text
+        return self._extract_staging_windows(text)
     
     def _load_llm(self):
-        """Lazy-load LLM model from local path."""
-        if not self.llm_model:
+        """
+        Lazy-load LLM model from local path.
+        
+        Uses a vLLM engine when vLLM is installed and a GPU is available, so that
+        all prompts for a file can be scheduled together with continuous batching.
+        Falls back to Hugging Face transformers otherwise. If server_url is set,
+        only the tokenizer is loaded and generation is done by the server.
+        """
+        if self.backend is None:
             logger.info("Loading local model...")
             try:
-                # Load model directly from local path
+                # Load tokenizer directly from local path
                 try:
-                    from transformers import AutoTokenizer, AutoModelForCausalLM
-                    import torch
-                    import accelerate
+                    from transformers import AutoTokenizer
                 except ImportError:
-                    logger.error("Failed to import transformers or torch. Make sure you've activated the correct environment:")
+                    logger.error("Failed to import transformers. Make sure you've activated the correct environment:")
                     logger.error("source /wynton/protected/home/zack/brtan/Virtual_Environments/dask_distribution_env/bin/activate")
                     raise
                 
@@ -109,246 +292,555 @@ class StagingExtractor:
                     logger.error(f"Model path not found: {self.model_path}")
                     raise FileNotFoundError(f"Model path not found: {self.model_path}")
                 
-                logger.info(f"Loading model from: {self.model_path}")
-                
-                # Load tokenizer and model from local path
+                # Load tokenizer from local path (used for context checks with every backend)
                 self.tokenizer = AutoTokenizer.from_pretrained(
                     self.model_path,
-                    local_files_only=True
+                    local_files_only=True,
+                    use_fast=True  # Rust tokenizer, needed for parallel batch encoding
                 )
+                # Llama has no pad token; pad on the left so generation continues from the prompt
+                if self.tokenizer.pad_token is None:
+                    self.tokenizer.pad_token = self.tokenizer.eos_token
+                self.tokenizer.padding_side = "left"
                 logger.info("✓ Tokenizer loaded successfully")
                 
+                # Tokenize the fixed prompt scaffolding once; prompts are built by
+                # concatenating these IDs with the tokenized note text. The prefix
+                # includes the special tokens (BOS) the tokenizer adds to a prompt.
+                self._template_prefix_ids = self.tokenizer.encode(PROMPT_PREFIX, add_special_tokens=True)
+                self._template_suffix_ids = self.tokenizer.encode(PROMPT_SUFFIX, add_special_tokens=False)
+                self._template_token_count = len(self._template_prefix_ids) + len(self._template_suffix_ids)
+                
+                # With a server, only the tokenizer is needed locally
+                if self.server_url:
+                    self.backend = "server"
+                    # The served weights (e.g. AWQ vs FP16) are reported as the model's root path
+                    import httpx
+                    response = httpx.get(f"{self.server_url}/models", timeout=30.0)
+                    response.raise_for_status()
+                    models = response.json()["data"]
+                    served = next((m.get("root") for m in models if m["id"] == self.server_model), self.server_model)
+                    self._set_cache_fingerprint(f"server:{served}")
+                    if self.compile_model:
+                        logger.warning("--compile only applies to the local transformers backend; ignored with --server-url")
+                    logger.info(f"✓ Using vLLM server at {self.server_url} (model: {self.server_model})")
+                    return
+                
+                try:
+                    from transformers import AutoModelForCausalLM
+                    import torch
+                    import accelerate
+                except ImportError:
+                    logger.error("Failed to import transformers or torch. Make sure you've activated the correct environment:")
+                    logger.error("source /wynton/protected/home/zack/brtan/Virtual_Environments/dask_distribution_env/bin/activate")
+                    raise
+                
+                # vLLM is optional; without it we use transformers.generate
+                try:
+                    from vllm import LLM
+                except ImportError:
+                    LLM = None
+                    logger.info("vLLM not installed, falling back to transformers")
+                
                 # Load model with appropriate device placement
                 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
                 logger.info(f"Using device: {device}")
                 
-                # Load model with lower precision for memory efficiency if using GPU
+                # Allow TF32 for any remaining FP32 matmuls
                 if device.type == "cuda":
+                    torch.backends.cuda.matmul.allow_tf32 = True
+                    torch.set_float32_matmul_precision("high")
+                
+                # Prefer the INT4 AWQ checkpoint on GPU: ~4x less weight memory leaves
+                # more room for KV cache and larger decode batches
+                quantized = (
+                    self.use_quantized
+                    and device.type == "cuda"
+                    and os.path.exists(self.quantized_model_path)
+                )
+                weights_path = self.quantized_model_path if quantized else self.model_path
+                logger.info(f"Loading model from: {weights_path}")
+                
+                # bfloat16 is Llama-3.1's native dtype; AWQ kernels and pre-Ampere GPUs need float16
+                use_bf16 = (
+                    device.type == "cuda"
+                    and not quantized
+                    and torch.cuda.is_bf16_supported()
+                )
+                
+                if LLM is not None and device.type == "cuda":
+                    # vLLM engine: PagedAttention + continuous batching across prompts
+                    self.llm_model = LLM(
+                        model=weights_path,
+                        tokenizer=self.model_path,
+                        dtype="bfloat16" if use_bf16 else "float16",
+                        quantization="awq" if quantized else None,
+                        max_model_len=self.max_context_length,
+                        gpu_memory_utilization=0.9,
+                    )
+                    self.backend = "vllm"
+                    if self.compile_model:
+                        logger.warning("--compile only applies to the transformers backend; ignored with vLLM")
+                # Load model with lower precision for memory efficiency if using GPU
+                elif device.type == "cuda":
+                    # transformers loads AWQ checkpoints natively when autoawq is installed
                     self.llm_model = AutoModelForCausalLM.from_pretrained(
-                        self.model_path,
+                        weights_path,
                         local_files_only=True,
-                        torch_dtype=torch.float16,  # Use half precision for GPU
-                        device_map="auto"  # Automatically distribute across available GPUs
+                        torch_dtype=torch.bfloat16 if use_bf16 else torch.float16,  # Use half precision for GPU
+                        device_map="auto",  # Automatically distribute across available GPUs
+                        attn_implementation=self._attention_implementation(torch),
                     )
+                    self.backend = "transformers"
+                    
+                    if self.compile_model:
+                        # Static KV cache gives fixed decode shapes; reduce-overhead captures CUDA graphs.
+                        # fullgraph=False lets dynamo break around accelerate's device_map hooks.
+                        self.llm_model.generation_config.cache_implementation = "static"
+                        self.llm_model.forward = torch.compile(
+                            self.llm_model.forward, mode="reduce-overhead", fullgraph=False
+                        )
+                        logger.info("✓ Model compiled with static KV cache")
                 else:
                     self.llm_model = AutoModelForCausalLM.from_pretrained(
                         self.model_path,
                         local_files_only=True
                     ).to(device)
+                    self.backend = "transformers"
+                    if self.compile_model:
+                        # Also stops _bucket_length padding prompts for graphs that are never compiled
+                        logger.warning("--compile needs a GPU; ignored on CPU")
+                        self.compile_model = False
                 
-                logger.info("✓ Model loaded successfully")
+                if device.type == "cuda":
+                    self._set_cache_fingerprint(f"{self.backend}:{weights_path}:{'bfloat16' if use_bf16 else 'float16'}")
+                else:
+                    self._set_cache_fingerprint(f"{self.backend}:{self.model_path}:float32")
+                logger.info(f"✓ Model loaded successfully (backend: {self.backend}, quantized: {quantized}, bf16: {use_bf16})")
             except Exception as e:
                 logger.error(f"Error loading model: {e}")
                 logger.error("Make sure you've activated the correct environment:")
                 logger.error("source /wynton/protected/home/zack/brtan/Virtual_Environments/dask_distribution_env/bin/activate")
                 raise
     
-    def _llm_extract(self, text: str) -> Dict[str, Optional[str]]:
+    @staticmethod
+    def _attention_implementation(torch) -> str:
         """
-        Extract staging information from clinical note text using LLM.
+        Pick the fastest available attention kernel for the transformers backend.
+        
+        FlashAttention-2 needs the flash-attn package and an Ampere or newer GPU;
+        otherwise PyTorch's fused scaled_dot_product_attention is used.
+        """
+        try:
+            import flash_attn  # noqa: F401
+        except ImportError:
+            return "sdpa"
+        major, _ = torch.cuda.get_device_capability()
+        return "flash_attention_2" if major >= 8 else "sdpa"
+    
+    def _max_prompt_tokens(self) -> int:
+        """Maximum number of prompt tokens, leaving room for the response."""
+        return min(self.tokenizer.model_max_length, self.max_context_length) - 100
+    
+    def _tokenize_batch(self, texts: List[str]) -> List[List[int]]:
+        """
+        Build the token IDs of the staging extraction prompt for each text.
+        
+        Only the note texts are tokenized, in one call to the Rust tokenizer
+        (which encodes the batch in parallel across threads); the prompt
+        scaffolding is tokenized once in _load_llm and concatenated around
+        them. Texts whose exact token count exceeds the context window are
+        shortened to their staging windows (see _extract_relevant_windows)
+        rather than cut from the end, leaving the instructions intact.
         
         Args:
-            text: The clinical note text
+            texts: Clinical note texts
             
         Returns:
-            Dict with extracted staging information or NA if none found
+            List of prompt token ID lists, in the same order as texts
         """
+        body_budget = self._max_prompt_tokens() - self._template_token_count
+        encode_batch = self.tokenizer.backend_tokenizer.encode_batch
+        body_ids = [encoding.ids for encoding in encode_batch(texts, add_special_tokens=False)]
+        
+        # Handle very long texts by keeping their most relevant parts
+        too_long = [i for i, ids in enumerate(body_ids) if len(ids) > body_budget]
+        if too_long:
+            logger.info(f"Shortening {len(too_long)} texts that exceed the context window")
+            shortened = [self._extract_relevant_windows(texts[i], self.max_window_chars) for i in too_long]
+            for i, encoding in zip(too_long, encode_batch(shortened, add_special_tokens=False)):
+                body_ids[i] = encoding.ids
+        
+        # Truncation only remains as a safeguard for shortened texts that are still too long
+        return [self._template_prefix_ids + ids[:body_budget] + self._template_suffix_ids for ids in body_ids]
+    
+    def _llm_extract_batch(self, texts: List[str]) -> List[str]:
+        """
+        Generate responses for a list of texts in a single call.
+        
+        With the vLLM backend all prompts are submitted at once and scheduled
+        with continuous batching. With a vLLM server all prompts are sent as
+        concurrent requests. With the transformers backend prompts are
+        sorted by length and generated in padded batches of similar length
+        (see _length_sorted_batches).
+        
+        Args:
+            texts: Clinical note texts; the prompt template is added around them
+            
+        Returns:
+            List of decoded responses, in the same order as texts
+        """
+        if not texts:
+            return []
+        
         # Load model if not already loaded
         self._load_llm()
         
-        # Construct prompt for staging extraction - adapted for Llama-3.1-8B
-        prompt = f"""<|system|>
-You are a medical assistant that extracts cancer staging information from clinical notes.
-<|user|>
-Analyze this clinical note and extract cancer staging information:
-
-{text}
-
-Respond with EXACTLY ONE of these formats (no additional text):
-1. "NA" if no staging information exists
-2. "Stage: [stage]" for general staging (e.g., "Stage: IIB") 
-3. "TNM: [classification]" for TNM classifications (e.g., "TNM: T2N1M0")
-<|assistant|>"""
-
-        try:
-            # Generate response using the model
-            import torch
+        # Tokenize all prompts once so every backend truncates identically
+        prompt_ids = self._tokenize_batch(texts)
+        
+        if self.backend == "server":
+            return asyncio.run(self._server_extract_batch(prompt_ids))
+        
+        if self.backend == "vllm":
+            from vllm import SamplingParams
+            
+            sampling_params = SamplingParams(temperature=0.0, max_tokens=self.max_new_tokens)
+            outputs = self.llm_model.generate(
+                [{"prompt_token_ids": ids} for ids in prompt_ids],
+                sampling_params,
+            )
+            # vLLM returns outputs in the same order as the inputs
+            return [output.outputs[0].text.strip() for output in outputs]
+        
+        import torch
+        
+        responses = [None] * len(prompt_ids)
+        for batch_positions in self._length_sorted_batches(prompt_ids):
+            batch_ids = [prompt_ids[i] for i in batch_positions]
             
-            # Handle very long texts by truncating to fit in context window
-            max_length = self.tokenizer.model_max_length
-            inputs = self.tokenizer(prompt, truncation=True, max_length=max_length - 100, return_tensors="pt")
+            # Left-pad this batch to its longest prompt, or to its length bucket
+            # when compiled so that graphs are reused
+            if self.compile_model:
+                padding = {"padding": "max_length", "max_length": self._bucket_length(max(map(len, batch_ids)))}
+            else:
+                padding = {"padding": True}
+            inputs = self.tokenizer.pad({"input_ids": batch_ids}, return_tensors="pt", **padding)
             
             # Move inputs to same device as model
-            inputs = {k: v.to(self.llm_model.device) for k, v in inputs.items()}
+            inputs = {k: v.to(self.llm_model.device, non_blocking=True) for k, v in inputs.items()}
             
-            # Generate response
-            with torch.no_grad():
+            # Generate responses; inference_mode also skips view/version tracking
+            with torch.inference_mode():
                 outputs = self.llm_model.generate(
                     **inputs, 
-                    max_new_tokens=50,      # Reduced since we expect short responses
-                    temperature=0.1,        # Low temperature for more focused output
+                    max_new_tokens=self.max_new_tokens,  # We expect short responses
                     do_sample=False,        # Deterministic generation
-                    pad_token_id=self.tokenizer.eos_token_id,  # Ensure proper padding
+                    pad_token_id=self.tokenizer.pad_token_id,  # Ensure proper padding
                 )
             
-            # Decode output
-            response = self.tokenizer.decode(outputs[0][inputs["input_ids"].shape[1]:], skip_special_tokens=True)
-            response = response.strip()
-            logger.debug(f"LLM response: {response}")
+            # Decode output; with left padding all new tokens start after the padded prompt
+            new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+            decoded = self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
             
-            # Parse the response
-            result = self._parse_llm_response(response)
-            return result
+            # Undo the length sort
+            for i, response in zip(batch_positions, decoded):
+                responses[i] = response.strip()
+        
+        return responses
+    
+    async def _server_extract_batch(self, prompt_ids: List[List[int]]) -> List[str]:
+        """
+        Send prompts to the vLLM server's completions endpoint concurrently.
+        
+        Args:
+            prompt_ids: Token IDs of each prompt
             
-        except Exception as e:
-            logger.error(f"Error in LLM extraction: {e}")
-            logger.error(f"Text snippet: {text[:100]}...")
-            return {"stage": None, "system": None}
+        Returns:
+            List of responses, in the same order as prompt_ids
+        """
+        import httpx
+        
+        semaphore = asyncio.Semaphore(self.server_concurrency)
+        
+        # httpx pools at most 100 connections by default; requests beyond the pool
+        # would wait for a connection while their timeout runs
+        limits = httpx.Limits(max_connections=self.server_concurrency)
+        async with httpx.AsyncClient(base_url=self.server_url, timeout=self.server_timeout, limits=limits) as client:
+            async def complete(ids: List[int]) -> str:
+                async with semaphore:
+                    response = await client.post("/completions", json={
+                        "model": self.server_model,
+                        "prompt": ids,
+                        "max_tokens": self.max_new_tokens,
+                        "temperature": 0.0,
+                    })
+                    response.raise_for_status()
+                    return response.json()["choices"][0]["text"].strip()
+            
+            return await asyncio.gather(*(complete(ids) for ids in prompt_ids))
     
-    def check_context_length(self, text: str) -> bool:
+    def _length_sorted_batches(self, prompt_ids: List[List[int]]) -> List[List[int]]:
         """
-        Check if the text fits within the model's context window.
+        Group prompts into generate batches of similar length.
+        
+        Prompts are sorted longest first and packed until the padded batch
+        (longest prompt x batch size) would exceed generation_token_budget, so
+        little compute is spent on padding tokens.
         
         Args:
-            text: The text to check
+            prompt_ids: Token IDs of each prompt
             
         Returns:
-            True if the text fits, False otherwise
+            List of batches, each a list of positions into prompt_ids
         """
-        # Load model if not already loaded
+        lengths = np.array([len(ids) for ids in prompt_ids])
+        order = np.argsort(lengths, kind="stable")[::-1]
+        
+        batches = []
+        current = []
+        for i in order:
+            # Sorted descending, so the first prompt in a batch is its longest
+            padded_length = self._bucket_length(lengths[current[0]] if current else lengths[i])
+            if current and padded_length * (len(current) + 1) > self.generation_token_budget:
+                batches.append(current)
+                current = []
+            current.append(int(i))
+        if current:
+            batches.append(current)
+        
+        return batches
+    
+    def _bucket_length(self, length: int) -> int:
+        """
+        Length a batch is padded to: its longest prompt, or with compile_model
+        the smallest length bucket that fits it.
+        """
+        if self.compile_model:
+            for bucket in self.length_buckets:
+                if length <= bucket:
+                    return bucket
+        return int(length)
+    
+    def _llm_extract_texts(self, texts: List[str]) -> List[Dict[str, Optional[str]]]:
+        """
+        Extract staging information from a list of texts with one batched LLM call.
+        
+        Args:
+            texts: Clinical note texts (single notes or concatenated patient notes)
+            
+        Returns:
+            List of dicts with extracted staging information, one per text
+        """
+        if not texts:
+            return []
+        
+        # Cache keys depend on the loaded model, so load it first
         self._load_llm()
         
-        # Construct the full prompt as we would in _llm_extract
-        prompt = f"""<|system|>
-You are a medical assistant that extracts cancer staging information from clinical notes.
-<|user|>
-Analyze this clinical note and extract cancer staging information:
-
-{text}
-
-Respond with EXACTLY ONE of these formats (no additional text):
-1. "NA" if no staging information exists
-2. "Stage: [stage]" for general staging (e.g., "Stage: IIB") 
-3. "TNM: [classification]" for TNM classifications (e.g., "TNM: T2N1M0")
-<|assistant|>"""
+        # Only submit texts we haven't seen before, once each
+        keys = [self._text_key(text) for text in texts]
+        pending = {}
+        for key, text in zip(keys, texts):
+            if key not in self.response_cache and key not in pending:
+                pending[key] = text
+        if len(pending) < len(texts):
+            logger.info(f"Reusing cached results for {len(texts) - len(pending)} of {len(texts)} texts")
         
-        # Check if the tokenized prompt length exceeds the model's context window
-        tokens = self.tokenizer(prompt, return_tensors="pt")
-        token_length = tokens.input_ids.shape[1]
-        max_length = self.tokenizer.model_max_length
+        # Model and server errors propagate so the file is reported as failed rather
+        # than written off as having no staging information
+        try:
+            responses = self._llm_extract_batch(list(pending.values()))
+        except Exception as e:
+            logger.error(f"Error in LLM extraction: {e}")
+            logger.error(f"Failed on a batch of {len(pending)} texts")
+            raise
         
-        # Allow some buffer for the response
-        fits_context = token_length < (max_length - 100)
+        # Parse the responses
+        for key, response in zip(pending, responses):
+            logger.debug(f"LLM response: {response}")
+            self.response_cache[key] = self._parse_llm_response(response)
         
-        if not fits_context:
-            logger.warning(f"Text exceeds context window: {token_length} tokens (max: {max_length - 100})")
+        # Fan results back out to every (possibly duplicate) text
+        return [dict(self.response_cache[key]) for key in keys]
+    
+    def _set_cache_fingerprint(self, model: str):
+        """
+        Fingerprint the model and the settings that LLM responses depend on.
         
-        return fits_context
+        Args:
+            model: Description of the backend and weights in use
+        """
+        settings = repr((model, PROMPT_PREFIX, PROMPT_SUFFIX, self.max_new_tokens,
+                         self.max_window_chars, self.max_context_length))
+        self._cache_fingerprint = hashlib.blake2b(settings.encode("utf-8"), digest_size=16).digest()
+    
+    def _text_key(self, text: str) -> bytes:
+        """Hash of a text keyed with the settings fingerprint, used as the response cache key."""
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16, key=self._cache_fingerprint).digest()
+    
+    def load_cache(self, cache_file: str):
+        """
+        Load previously extracted results so reruns skip already-seen texts.
+        
+        Args:
+            cache_file: Path to a pickle written by save_cache
+        """
+        if not os.path.exists(cache_file):
+            return
+        try:
+            with open(cache_file, "rb") as f:
+                self.response_cache.update(pickle.load(f))
+            logger.info(f"Loaded {len(self.response_cache)} cached results from {cache_file}")
+        except Exception as e:
+            logger.warning(f"Failed to load cache {cache_file}: {e}")
+    
+    def save_cache(self, cache_file: str):
+        """
+        Save extracted results, merged with any results already in the cache file.
+        
+        The read-merge-write runs under an exclusive lock on <cache_file>.lock so
+        concurrent jobs don't drop each other's entries, and the file is replaced
+        atomically so readers never see a partial write.
+        
+        Args:
+            cache_file: Path to write the pickle to
+        """
+        with open(f"{cache_file}.lock", "a") as lock:
+            # POSIX record lock, which (unlike flock) also works on NFS
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                cache = {}
+                if os.path.exists(cache_file):
+                    try:
+                        with open(cache_file, "rb") as f:
+                            cache = pickle.load(f)
+                    except Exception as e:
+                        logger.warning(f"Failed to read existing cache {cache_file}, overwriting: {e}")
+                cache.update(self.response_cache)
+                
+                temp_file = f"{cache_file}.{os.getpid()}.tmp"
+                with open(temp_file, "wb") as f:
+                    pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(temp_file, cache_file)
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+        logger.info(f"Saved {len(cache)} cached results to {cache_file}")
     
-    def process_patient_batch(self, patient_notes: pd.DataFrame) -> pd.DataFrame:
+    def _tag_notes(self, notes_df: pd.DataFrame) -> pd.Series:
         """
-        Process all notes for a single patient as a batch.
+        Prefix each note with a note separator.
+        
+        Notes are numbered by their position within the patient (1, 2, ...), not
+        by row, so patients with identical notes get identical prompts and share
+        one response cache entry.
         
         Args:
-            patient_notes: DataFrame containing notes for a single patient
+            notes_df: Candidate notes from read_candidates (already pre-filtered,
+                no empty notes) with a patientdurablekey column
             
         Returns:
-            DataFrame with only rows containing staging information
+            Series of tagged note texts with the same index as notes_df
         """
-        if patient_notes.empty:
-            return pd.DataFrame()
-        
-        # Extract patient ID for logging
-        patientdurablekey = patient_notes.iloc[0].get('patientdurablekey', 'unknown')
+        # Build "--- NOTE <n> ---\n<text>" with Arrow string kernels rather than per-note f-strings
+        texts = notes_df['note_text'].astype(pd.ArrowDtype(pa.string()))
+        note_numbers = notes_df.groupby('patientdurablekey', sort=False, dropna=False).cumcount() + 1
+        note_ids = note_numbers.astype(str).astype(pd.ArrowDtype(pa.string()))
+        return "--- NOTE " + note_ids + " ---\n" + texts
+    
+    def _concatenate_notes_by_patient(self, df: pd.DataFrame) -> pd.Series:
+        """
+        Concatenate the notes of every patient in one groupby pass.
         
-        # Concatenate all notes for this patient with separators
-        all_notes = []
-        for idx, row in patient_notes.iterrows():
-            text = row.get('note_text', '')
-            if isinstance(text, str) and text.strip():
-                # Add a separator between notes
-                all_notes.append(f"--- NOTE {idx} ---\n{text}")
+        Args:
+            df: Candidate notes from read_candidates with a patientdurablekey column
+            
+        Returns:
+            Series of concatenated note text indexed by patientdurablekey
+        """
+        tagged = self._tag_notes(df)
+        return tagged.groupby(df.loc[tagged.index, 'patientdurablekey'], sort=False).agg("\n\n".join)
+    
+    def _fits_patients_context(self, concatenated: pd.Series) -> pd.Series:
+        """
+        Check which patients' concatenated notes fit in a single prompt.
         
-        if not all_notes:
-            return pd.DataFrame()
+        The character-based estimate decides clear cases: well under the budget
+        (<= 80% of it) fits, over the budget doesn't. Only the borderline band in
+        between is tokenized, in one batch call to the Rust tokenizer.
         
-        # Join all notes with double line breaks
-        concatenated_text = "\n\n".join(all_notes)
+        Args:
+            concatenated: Concatenated note text indexed by patientdurablekey
+            
+        Returns:
+            Boolean Series with the same index; False means the patient's notes
+            should be processed individually
+        """
+        limit = self.max_context_length - 100
+        safe_limit = int(0.8 * limit)
         
         # First do a quick estimation of token count before loading the model
-        estimated_tokens = self._estimate_token_count(concatenated_text)
-        estimated_prompt_tokens = estimated_tokens + 200  # Add buffer for prompt template
+        estimated_prompt_tokens = (concatenated.str.len() / self.avg_chars_per_token).astype(int) + 200  # Add buffer for prompt template
+        fits = estimated_prompt_tokens <= safe_limit
         
         # Check if we're likely to exceed context window
-        if estimated_prompt_tokens > (self.max_context_length - 100):
-            logger.warning(f"Estimated tokens for patient {patientdurablekey}: {estimated_prompt_tokens}, which likely exceeds context window. Processing individually.")
-            return self._process_individual_notes(patient_notes)
-        
-        # If we're here, it's worth loading the model to do a precise check
-        # Check if the concatenated text fits within the model's context window
-        if not self.check_context_length(concatenated_text):
-            logger.warning(f"Concatenated notes for patient {patientdurablekey} exceed context window. Processing individually.")
-            # Fall back to processing notes individually
-            return self._process_individual_notes(patient_notes)
-        
-        # Process the concatenated notes
-        logger.info(f"Processing {len(patient_notes)} notes for patient {patientdurablekey} as a batch")
-        staging_info = self._llm_extract(concatenated_text)
-        
-        # If staging information was found, apply it to all notes in the batch
-        if staging_info.get('stage') is not None:
-            # Create a copy of the patient notes with staging information
-            result_df = patient_notes.copy()
-            result_df['stage'] = staging_info.get('stage')
-            result_df['system'] = staging_info.get('system')
-            logger.info(f"Found staging information for patient {patientdurablekey}: {staging_info}")
-            return result_df
-        else:
-            logger.info(f"No staging information found for patient {patientdurablekey}")
-            return pd.DataFrame()
+        too_long = estimated_prompt_tokens > limit
+        for patientdurablekey, estimate in estimated_prompt_tokens[too_long].items():
+            logger.warning(f"Estimated tokens for patient {patientdurablekey}: {estimate}, which likely exceeds context window. Processing individually.")
+        
+        # For the borderline band it's worth loading the tokenizer to do a precise check
+        borderline = ~fits & ~too_long
+        if borderline.any():
+            self._load_llm()
+            encodings = self.tokenizer.backend_tokenizer.encode_batch(
+                concatenated[borderline].tolist(), add_special_tokens=False
+            )
+            token_lengths = pd.Series(
+                [len(encoding.ids) for encoding in encodings],
+                index=concatenated.index[borderline],
+            ) + self._template_token_count
+            exact_fits = token_lengths < self._max_prompt_tokens()
+            for patientdurablekey, token_length in token_lengths[~exact_fits].items():
+                logger.warning(f"Concatenated notes for patient {patientdurablekey} exceed context window ({token_length} tokens). Processing individually.")
+            fits.loc[exact_fits.index] = exact_fits.to_numpy()
+        
+        return fits
     
     def _process_individual_notes(self, notes_df: pd.DataFrame) -> pd.DataFrame:
         """
         Process notes individually when batching fails.
         
         Args:
-            notes_df: DataFrame containing notes
+            notes_df: Candidate notes from read_candidates (already pre-filtered, no empty notes)
             
         Returns:
             DataFrame with only rows containing staging information
         """
-        # Create empty columns for staging info if they don't exist
-        if 'stage' not in notes_df.columns:
-            notes_df['stage'] = None
-        if 'system' not in notes_df.columns:
-            notes_df['system'] = None
+        # Work on plain Python lists rather than iterrows()/.at per row
+        texts = notes_df['note_text'].tolist()
         
-        # Track rows with staging info
-        has_staging = []
+        # Extract staging information for all notes in one batched call
+        logger.info(f"Processing {len(texts)} notes individually")
+        staging_infos = self._llm_extract_texts(texts)
         
-        # Process each note
-        for idx, row in tqdm(notes_df.iterrows(), total=len(notes_df), desc="Processing individual notes"):
-            text = row.get('note_text', '')
-            if not isinstance(text, str) or not text.strip():
-                continue
-                
-            # Extract staging information
-            staging_info = self._llm_extract(text)
-            
-            # Store results in the dataframe
-            notes_df.at[idx, 'stage'] = staging_info.get('stage')
-            notes_df.at[idx, 'system'] = staging_info.get('system')
-            
+        stages = [None] * len(texts)
+        systems = [None] * len(texts)
+        keep = []
+        for i, staging_info in enumerate(staging_infos):
+            stages[i] = staging_info.get('stage')
+            systems[i] = staging_info.get('system')
             # Track if this note has staging info
-            has_staging.append(idx if staging_info.get('stage') is not None else None)
+            if stages[i] is not None:
+                keep.append(i)
         
         # Filter to only rows with staging information
-        has_staging = [i for i in has_staging if i is not None]
-        if has_staging:
-            result_df = notes_df.loc[has_staging].copy()
-            return result_df
-        else:
+        if not keep:
             return pd.DataFrame()
+        
+        result_df = notes_df.iloc[keep].copy()
+        result_df['stage'] = [stages[i] for i in keep]
+        result_df['system'] = [systems[i] for i in keep]
+        return result_df
     
     def _parse_llm_response(self, response: str) -> Dict[str, Optional[str]]:
         """
@@ -361,172 +853,320 @@ Respond with EXACTLY ONE of these formats (no additional text):
         Returns:
             Dict with stage and system information, or None values if not found
         """
-        # Default result if no staging information
-        result = {"stage": None, "system": None}
-        
         # Quick check for NA response
         if "NA" in response:
-            return result
-            
-        # Fast check for TNM format
+            return {"stage": None, "system": None}
+        
+        # Fast check for TNM format; an empty value falls through to the next format
         if "TNM:" in response:
-            # Extract everything after "TNM:"
-            tnm_text = response.split("TNM:", 1)[1].strip()
-            # Take only the first line if multiple lines
-            if "\n" in tnm_text:
-                tnm_text = tnm_text.split("\n", 1)[0].strip()
-            result["stage"] = tnm_text
-            result["system"] = "TNM"
-            return result
-            
+            tnm_text = self._label_value(response.split("TNM:", 1)[1])
+            if tnm_text:
+                return {"stage": tnm_text, "system": "TNM"}
+        
         # Fast check for Stage format
         if "Stage:" in response:
-            # Extract everything after "Stage:"
-            stage_text = response.split("Stage:", 1)[1].strip()
-            # Take only the first line if multiple lines
-            if "\n" in stage_text:
-                stage_text = stage_text.split("\n", 1)[0].strip()
-            result["stage"] = stage_text
-            result["system"] = "General"
-            return result
-            
+            stage_text = self._label_value(response.split("Stage:", 1)[1])
+            if stage_text:
+                return {"stage": stage_text, "system": "General"}
+        
         # Direct TNM pattern as fallback (e.g., T2N1M0)
         if "T" in response and "N" in response and "M" in response:
             for word in response.split():
-                if word.startswith("T") and "N" in word and "M" in word:
-                    result["stage"] = word.strip(".,;:()")
-                    result["system"] = "TNM"
-                    return result
+                if word.startswith("T") and "N" in word and "M" in word and not word.startswith("TNM:"):
+                    return {"stage": word.strip(".,;:()"), "system": "TNM"}
         
-        return result
+        return {"stage": None, "system": None}
+    
+    def _label_value(self, text: str) -> str:
+        """
+        Extract the value that follows a "TNM:" or "Stage:" label.
+        
+        Args:
+            text: The response text after the label
+            
+        Returns:
+            The value up to the end of its line, the next label, a comma/semicolon
+            or a sentence end (may be empty)
+        """
+        # Take only the first line if multiple lines
+        value = text.strip().split("\n", 1)[0]
+        # Plain substring checks first; most values contain no delimiter at all
+        if "," in value or ";" in value or "." in value or ":" in value:
+            match = self._value_end_re.search(value)
+            if match is not None:
+                value = value[:match.start()]
+        return value.strip()
 
-def process_file(file_path: str, extractor: StagingExtractor) -> pd.DataFrame:
+def iter_notes(file_path: str, columns: Optional[List[str]] = None,
+               batch_size: int = STREAM_BATCH_SIZE) -> Iterator[pd.DataFrame]:
     """
-    Process a single parquet file to extract staging information.
+    Stream notes with non-empty note_text from a parquet file in record batches.
+    
+    Column projection and the non-empty note_text predicate are pushed down into
+    the parquet scan, and each batch uses Arrow-backed dtypes. Batches are indexed
+    by row number within the filtered file, so repeated scans line up.
+    
+    Args:
+        file_path: Path to the parquet file
+        columns: Columns to read (columns missing from the file are skipped), or None for all columns
+        batch_size: Maximum rows per batch
+        
+    Yields:
+        DataFrames of notes
+    """
+    dataset = ds.dataset(file_path, format="parquet")
+    if columns is not None:
+        columns = [c for c in columns if c in dataset.schema.names]
+    offset = 0
+    for record_batch in dataset.to_batches(
+        columns=columns,
+        filter=ds.field("note_text") != "",  # Also drops null note_text
+        batch_size=batch_size,
+    ):
+        notes = record_batch.to_pandas(types_mapper=pd.ArrowDtype)
+        notes.index = pd.RangeIndex(offset, offset + len(notes))
+        offset += len(notes)
+        yield notes
+
+def read_candidates(file_path: str, extractor: StagingExtractor, patient_batching: bool = True) -> pd.DataFrame:
+    """
+    Stream a parquet file and keep only the text of each note the LLM will see.
+    
+    With the pre-filter these are short windows around candidate staging
+    mentions, so peak memory does not scale with the full note text. This is
+    the CPU-only part of extraction and doesn't need the model.
+    
+    Args:
+        file_path: Path to the parquet file
+        extractor: StagingExtractor instance (only its pre-filter is used)
+        patient_batching: If False, drop patientdurablekey so every note is processed individually
+        
+    Returns:
+        DataFrame of candidate notes indexed by row number as in iter_notes
+    """
+    candidates = []
+    total_notes = 0
+    for notes in iter_notes(file_path, INPUT_COLUMNS):
+        total_notes += len(notes)
+        
+        # Force individual note processing by dropping patientdurablekey
+        if not patient_batching:
+            notes = notes.drop(columns=['patientdurablekey'], errors='ignore')
+        
+        texts = notes['note_text'].map(extractor._prefilter_text)
+        keep = texts.ne("")
+        candidates.append(notes[keep].assign(note_text=texts[keep]))
+    
+    if not candidates:
+        return pd.DataFrame(columns=['note_text'])
+    
+    # Later steps use these texts as they are, without scanning them again
+    df = pd.concat(candidates)
+    logger.info(f"{len(df)} of {total_notes} notes in {file_path} have text to process")
+    return df
+
+def _read_candidates_worker(file_path: str, use_prefilter: bool, patient_batching: bool) -> pd.DataFrame:
+    """Run read_candidates in a prefetch worker process with its own (model-less) extractor."""
+    extractor = StagingExtractor()
+    extractor.use_prefilter = use_prefilter
+    return read_candidates(file_path, extractor, patient_batching)
+
+def extract_file_staging(file_path: str, extractor: StagingExtractor, patient_batching: bool = True,
+                         candidates: Optional[pd.DataFrame] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Extract staging information for the notes in a parquet file.
     Groups notes by patient and processes each patient's notes as a batch.
     
     Args:
         file_path: Path to the parquet file
         extractor: StagingExtractor instance
+        patient_batching: If False, process every note individually
+        candidates: Output of read_candidates for this file, if already read
+        
+    Returns:
+        Tuple of (patient-level results indexed by patientdurablekey,
+        note-level results indexed by row number as in iter_notes), each with
+        stage and system columns and only rows where staging was found
+    """
+    no_staging = pd.DataFrame(columns=['stage', 'system'])
+    
+    df = candidates if candidates is not None else read_candidates(file_path, extractor, patient_batching)
+    if df.empty:
+        return no_staging, no_staging
+    
+    logger.info(f"Processing {len(df)} notes...")
+    
+    # Check if patientdurablekey column exists
+    if 'patientdurablekey' not in df.columns:
+        logger.warning("No patientdurablekey column found. Processing notes individually.")
+        individual_results = extractor._process_individual_notes(df)
+        if individual_results.empty:
+            return no_staging, no_staging
+        return no_staging, individual_results[['stage', 'system']]
+    
+    # Build the concatenated text for every patient in one pass
+    concatenated = extractor._concatenate_notes_by_patient(df)
+    logger.info(f"Found {df['patientdurablekey'].nunique()} patients with note text to process")
+    
+    # Patients whose notes don't fit in the context window are processed note by note instead
+    fits = extractor._fits_patients_context(concatenated)
+    batch = concatenated[fits]
+    
+    # Submit all patient prompts in a single batched LLM call
+    logger.info(f"Submitting {len(batch)} patient prompts to the LLM")
+    patient_staging = pd.DataFrame(
+        extractor._llm_extract_texts(batch.tolist()),
+        index=batch.index,
+        columns=['stage', 'system'],
+    )
+    patient_staging = patient_staging[patient_staging['stage'].notna()]
+    
+    note_staging = no_staging
+    overflow_keys = concatenated.index[~fits]
+    if len(overflow_keys):
+        individual_results = extractor._process_individual_notes(df[df['patientdurablekey'].isin(overflow_keys)])
+        if not individual_results.empty:
+            note_staging = individual_results[['stage', 'system']]
+    
+    return patient_staging, note_staging
+
+def process_file(file_path: str, extractor: StagingExtractor, output_file: str, csv_file: Optional[str] = None,
+                 patient_batching: bool = True, output_columns: Optional[List[str]] = None,
+                 candidates: Optional[pd.DataFrame] = None) -> int:
+    """
+    Process a single parquet file to extract staging information.
+    
+    Staging is extracted in a first streaming pass (see extract_file_staging).
+    A second streaming pass writes the notes with staging information to
+    output_file batch by batch, so the full result is never held in memory.
+    Nothing is written if no staging information is found. Read and LLM errors
+    are re-raised so a failed file is not mistaken for one without staging.
+    
+    Args:
+        file_path: Path to the parquet file
+        extractor: StagingExtractor instance
+        output_file: Parquet file to write results to
+        csv_file: Optional CSV file to also write results to
+        patient_batching: If False, process every note individually
+        output_columns: Input columns to write besides patientdurablekey and note_text;
+            None (the default) writes every input column
+        candidates: Output of read_candidates for this file, if already read
         
     Returns:
-        DataFrame with only rows containing staging information
+        Number of notes with staging information
     """
     try:
         logger.info(f"Reading file: {file_path}")
-        df = pd.read_parquet(file_path)
+        patient_staging, note_staging = extract_file_staging(file_path, extractor, patient_batching, candidates)
         
-        logger.info(f"Processing {len(df)} notes...")
+        if patient_staging.empty and note_staging.empty:
+            logger.info("No staging information found in this file")
+            return 0
         
-        # Check if patientdurablekey column exists
-        if 'patientdurablekey' not in df.columns:
-            logger.warning("No patientdurablekey column found. Processing notes individually.")
-            # Create empty columns for staging info
-            df['stage'] = None
-            df['system'] = None
-            
-            # Track rows with staging info
-            has_staging = []
-            
-            # Process each note
-            for idx, row in tqdm(df.iterrows(), total=len(df), desc="Extracting staging info"):
-                text = row['note_text']
-                if not isinstance(text, str) or not text.strip():
-                    continue
-                    
-                # Extract staging information
-                staging_info = extractor._llm_extract(text)
+        writer = None
+        csv_writer = None
+        total_rows = 0
+        try:
+            columns = None if output_columns is None else INPUT_COLUMNS + output_columns
+            for notes in iter_notes(file_path, columns):
+                # Patient-level results apply to all of the patient's notes
+                if not patient_staging.empty:
+                    stage = notes['patientdurablekey'].map(patient_staging['stage']).astype(object)
+                    system = notes['patientdurablekey'].map(patient_staging['system']).astype(object)
+                else:
+                    stage = pd.Series(None, index=notes.index, dtype=object)
+                    system = pd.Series(None, index=notes.index, dtype=object)
                 
-                # Store results in the dataframe
-                df.at[idx, 'stage'] = staging_info.get('stage')
-                df.at[idx, 'system'] = staging_info.get('system')
+                # Note-level results for notes that were processed individually
+                rows = notes.index.intersection(note_staging.index)
+                stage.loc[rows] = note_staging.loc[rows, 'stage']
+                system.loc[rows] = note_staging.loc[rows, 'system']
                 
-                # Track if this note has staging info
-                has_staging.append(idx if staging_info.get('stage') is not None else None)
-            
-            # Filter to only rows with staging information
-            has_staging = [i for i in has_staging if i is not None]
-            if has_staging:
-                result_df = df.loc[has_staging].copy()
-                logger.info(f"Found {len(result_df)} notes with staging information")
-                return result_df
-            else:
-                logger.info("No staging information found in this file")
-                return pd.DataFrame()
-        
-        # Group notes by patientdurablekey
-        patient_groups = df.groupby('patientdurablekey')
-        logger.info(f"Found {len(patient_groups)} unique patients")
-        
-        # Process each patient's notes as a batch
-        all_results = []
-        for patientdurablekey, patient_df in tqdm(patient_groups, desc="Processing patients"):
-            # Process this patient's notes as a batch
-            patient_results = extractor.process_patient_batch(patient_df)
-            if not patient_results.empty:
-                all_results.append(patient_results)
-        
-        # Combine all results
-        if all_results:
-            result_df = pd.concat(all_results, ignore_index=True)
-            logger.info(f"Found {len(result_df)} notes with staging information across {len(all_results)} patients")
-            return result_df
-        else:
-            logger.info("No staging information found in this file")
-            return pd.DataFrame()
+                has_staging = stage.notna()
+                if not has_staging.any():
+                    continue
+                
+                result = notes[has_staging].assign(
+                    stage=stage[has_staging].astype(pd.ArrowDtype(pa.string())),
+                    system=system[has_staging].astype(pd.ArrowDtype(pa.string())),
+                )
+                table = pa.Table.from_pandas(result, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(output_file, table.schema)
+                    if csv_file:
+                        csv_writer = pacsv.CSVWriter(csv_file, table.schema)
+                writer.write_table(table)
+                if csv_writer is not None:
+                    csv_writer.write_table(table)
+                total_rows += table.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+            if csv_writer is not None:
+                csv_writer.close()
+        
+        logger.info(f"Found {total_rows} notes with staging information")
+        logger.info(f"Saved results to {output_file}" + (f" and {csv_file}" if csv_file else ""))
+        return total_rows
             
     except Exception as e:
         logger.error(f"Error processing file {file_path}: {e}")
-        return pd.DataFrame()
+        raise
+
+def quantize_model(model_path: str, output_path: str, calib_file: Optional[str] = None):
+    """
+    Quantize the model to INT4 with AutoAWQ and save it for StagingExtractor to load.
+    
+    This only needs to be run once per model. The tokenizer is saved unchanged
+    alongside the quantized weights.
+    
+    Without calib_file, AutoAWQ downloads its default calibration set ("pileval")
+    from the Hugging Face Hub, which needs network access. On offline nodes pass
+    a local text file instead.
+    
+    Args:
+        model_path: Path to the FP16 model checkpoint
+        output_path: Directory to save the quantized checkpoint to
+        calib_file: Optional local calibration text file, one sample per line
+            (AutoAWQ skips samples longer than 512 tokens)
+    """
+    try:
+        from awq import AutoAWQForCausalLM
+        from transformers import AutoTokenizer
+    except ImportError:
+        logger.error("Failed to import autoawq. Install it with: pip install autoawq")
+        raise
+    
+    quant_config = {"zero_point": True, "q_group_size": 128, "w_bit": 4, "version": "GEMM"}
+    
+    logger.info(f"Loading model for quantization from: {model_path}")
+    model = AutoAWQForCausalLM.from_pretrained(model_path, low_cpu_mem_usage=True, use_cache=False)
+    tokenizer = AutoTokenizer.from_pretrained(model_path, local_files_only=True)
+    
+    if calib_file:
+        with open(calib_file, encoding="utf-8") as f:
+            calib_data = [line.strip() for line in f if line.strip()]
+        if not calib_data:
+            raise ValueError(f"Calibration file has no samples: {calib_file}")
+        logger.info(f"Using {len(calib_data)} calibration samples from {calib_file}")
+    else:
+        calib_data = "pileval"
+        logger.info("No --calib-file given: downloading the pileval calibration set from the Hugging Face Hub")
+    
+    logger.info(f"Quantizing with config: {quant_config}")
+    model.quantize(tokenizer, quant_config=quant_config, calib_data=calib_data)
+    
+    model.save_quantized(output_path)
+    tokenizer.save_pretrained(output_path)
+    logger.info(f"Saved quantized model to {output_path}")
 
 def test_parsing_logic():
     """
     Test function to verify the parsing logic works with different LLM output formats.
     This function tests only the parsing logic without loading the model.
     """
-    # Create a minimal extractor instance without loading the model
-    class MinimalExtractor:
-        def _parse_llm_response(self, response):
-            # Copy of the parsing logic for testing
-            result = {"stage": None, "system": None}
-            
-            # Quick check for NA response
-            if "NA" in response:
-                return result
-                
-            # Fast check for TNM format
-            if "TNM:" in response:
-                # Extract everything after "TNM:"
-                tnm_text = response.split("TNM:", 1)[1].strip()
-                # Take only the first line if multiple lines
-                if "\n" in tnm_text:
-                    tnm_text = tnm_text.split("\n", 1)[0].strip()
-                result["stage"] = tnm_text
-                result["system"] = "TNM"
-                return result
-                
-            # Fast check for Stage format
-            if "Stage:" in response:
-                # Extract everything after "Stage:"
-                stage_text = response.split("Stage:", 1)[1].strip()
-                # Take only the first line if multiple lines
-                if "\n" in stage_text:
-                    stage_text = stage_text.split("\n", 1)[0].strip()
-                result["stage"] = stage_text
-                result["system"] = "General"
-                return result
-                
-            # Direct TNM pattern as fallback (e.g., T2N1M0)
-            if "T" in response and "N" in response and "M" in response:
-                for word in response.split():
-                    if word.startswith("T") and "N" in word and "M" in word:
-                        result["stage"] = word.strip(".,;:()")
-                        result["system"] = "TNM"
-                        return result
-            
-            return result
-    
-    extractor = MinimalExtractor()
+    # The model is loaded lazily, so creating an extractor doesn't load it
+    extractor = StagingExtractor()
     
     test_cases = [
         # Simple format responses - these match our expected LLM output format
@@ -542,6 +1182,16 @@ def test_parsing_logic():
         # Llama-3.1-8B specific formats
         {"response": "Based on the clinical note, TNM: T2N0M0", "expected": {"stage": "T2N0M0", "system": "TNM"}},
         {"response": "After reviewing the note, Stage: IIIA", "expected": {"stage": "IIIA", "system": "General"}},
+        
+        # Several labels in one response: TNM: wins, then Stage:, then a bare TNM word
+        {"response": "Stage: IIB, TNM: T2N1M0", "expected": {"stage": "T2N1M0", "system": "TNM"}},
+        {"response": "TNM: T2N1M0, Stage: IIB", "expected": {"stage": "T2N1M0", "system": "TNM"}},
+        {"response": "T2N1M0. Stage: IIB", "expected": {"stage": "IIB", "system": "General"}},
+        {"response": "Stage: IIIA; TNM pending", "expected": {"stage": "IIIA", "system": "General"}},
+        
+        # An empty labelled value is not staging information
+        {"response": "TNM: \nStage: IIB", "expected": {"stage": "IIB", "system": "General"}},
+        {"response": "TNM: ", "expected": {"stage": None, "system": None}},
     ]
     
     print("\nTesting simplified parsing logic with different LLM output formats:")
@@ -561,7 +1211,38 @@ def test_parsing_logic():
         print(f"Input: {test['response']}")
         print(f"Expected: {expected}")
         print(f"Got: {result}")
-        
+    
+    # Note text the regex pre-filter must keep (True) or skip (False)
+    prefilter_cases = [
+        {"text": "Pathologic stage IIB adenocarcinoma", "expected": True},
+        {"text": "Stage: IIB", "expected": True},
+        {"text": "Stage:IIIA", "expected": True},
+        {"text": "AJCC stage group IIB", "expected": True},
+        {"text": "Final staging: pT3 pN1a", "expected": True},
+        {"text": "pT2 pN0 cM0", "expected": True},
+        {"text": "T2N0", "expected": True},
+        {"text": "cT2N1M0 by imaging", "expected": True},
+        {"text": "FIGO stage IIIC1", "expected": True},
+        {"text": "Stage IB2", "expected": True},
+        {"text": "stage IA1", "expected": True},
+        {"text": "pT1c pN1mi M0", "expected": True},
+        {"text": "pT1a(m) N0", "expected": True},
+        {"text": "T2, N0, M0", "expected": True},
+        {"text": "pStage IIA", "expected": True},
+        {"text": "Follow-up visit, no evidence of disease.", "expected": False},
+    ]
+    
+    print("\nTesting regex pre-filter with different staging mentions:")
+    print("=" * 60)
+    
+    for i, test in enumerate(prefilter_cases, 1):
+        result = extractor._prefilter_text(test["text"]) != ""
+        status = "✓ PASS" if result == test["expected"] else "✗ FAIL"
+        print(f"\nTest {i}: {status}")
+        print(f"Input: {test['text']}")
+        print(f"Expected candidate: {test['expected']}")
+        print(f"Got: {result}")
+    
     print("\nTesting complete!")
 
 def benchmark_parsing():
@@ -571,49 +1252,8 @@ def benchmark_parsing():
     """
     import time
     
-    # Use the same minimal extractor as in test_parsing_logic
-    class MinimalExtractor:
-        def _parse_llm_response(self, response):
-            # Copy of the parsing logic for testing
-            result = {"stage": None, "system": None}
-            
-            # Quick check for NA response
-            if "NA" in response:
-                return result
-                
-            # Fast check for TNM format
-            if "TNM:" in response:
-                # Extract everything after "TNM:"
-                tnm_text = response.split("TNM:", 1)[1].strip()
-                # Take only the first line if multiple lines
-                if "\n" in tnm_text:
-                    tnm_text = tnm_text.split("\n", 1)[0].strip()
-                result["stage"] = tnm_text
-                result["system"] = "TNM"
-                return result
-                
-            # Fast check for Stage format
-            if "Stage:" in response:
-                # Extract everything after "Stage:"
-                stage_text = response.split("Stage:", 1)[1].strip()
-                # Take only the first line if multiple lines
-                if "\n" in stage_text:
-                    stage_text = stage_text.split("\n", 1)[0].strip()
-                result["stage"] = stage_text
-                result["system"] = "General"
-                return result
-                
-            # Direct TNM pattern as fallback (e.g., T2N1M0)
-            if "T" in response and "N" in response and "M" in response:
-                for word in response.split():
-                    if word.startswith("T") and "N" in word and "M" in word:
-                        result["stage"] = word.strip(".,;:()")
-                        result["system"] = "TNM"
-                        return result
-            
-            return result
-    
-    extractor = MinimalExtractor()
+    # The model is loaded lazily, so creating an extractor doesn't load it
+    extractor = StagingExtractor()
     
     # Create a large list of test responses
     test_responses = []
@@ -646,15 +1286,240 @@ def benchmark_parsing():
     print(f"Parses per second: {len(test_responses) / total_time:.2f}")
     print("=" * 60)
 
+# Default locations of the filtered note batches and the staging results
+INPUT_FILE_TEMPLATE = "/wynton/protected/home/zack/brtan/Stage_2_Staging_Extractor/data/output/filtered_notes/final/filtered_notes_batch_{}.parquet"
+OUTPUT_DIR = "/wynton/protected/home/zack/brtan/Stage_2_Staging_Extractor/data/output/staging_results"
+
+def process_batch(batch_number: int, extractor: StagingExtractor, output_dir: str, use_cache: bool = True,
+                  patient_batching: bool = True, output_columns: Optional[List[str]] = None,
+                  candidates: Optional[pd.DataFrame] = None) -> int:
+    """
+    Process one batch file and save its results.
+    
+    Args:
+        batch_number: Batch number to process
+        extractor: StagingExtractor instance
+        output_dir: Directory to save results (and the results cache) to
+        use_cache: Whether to load and update staging_cache.pkl
+        patient_batching: If False, process every note individually
+        output_columns: Input columns to write besides patientdurablekey and note_text (default: all)
+        candidates: Output of read_candidates for this batch's file, if already read
+        
+    Returns:
+        Number of notes with staging information
+    """
+    input_file = INPUT_FILE_TEMPLATE.format(batch_number)
+    logger.info(f"Input file: {input_file}")
+    
+    # Check if input file exists
+    if not os.path.exists(input_file):
+        logger.error(f"Input file not found: {input_file}")
+        return 0
+    
+    # Reuse results for texts already extracted by earlier runs
+    cache_file = os.path.join(output_dir, "staging_cache.pkl")
+    if use_cache:
+        extractor.load_cache(cache_file)
+    
+    # Process the file, writing results as parquet and also as CSV for easier inspection
+    try:
+        return process_file(
+            input_file,
+            extractor,
+            output_file=os.path.join(output_dir, f"staging_results_batch_{batch_number}.parquet"),
+            csv_file=os.path.join(output_dir, f"staging_results_batch_{batch_number}.csv"),
+            patient_batching=patient_batching,
+            output_columns=output_columns,
+            candidates=candidates,
+        )
+    finally:
+        # Results extracted before a failure are still valid
+        if use_cache:
+            try:
+                extractor.save_cache(cache_file)
+            except Exception as e:
+                logger.warning(f"Failed to save cache {cache_file}: {e}")
+
+def process_batches_sequentially(batch_numbers: List[int], extractor: StagingExtractor, output_dir: str,
+                                 **kwargs) -> Tuple[int, List[int]]:
+    """
+    Process batch files one after another, reusing one extractor and its loaded model.
+    
+    While a batch is on the GPU, the next batch's file is read and pre-filtered
+    in a background process, so CPU preprocessing overlaps generation.
+    
+    Args:
+        batch_numbers: Batch numbers to process
+        extractor: StagingExtractor instance, shared by all batches
+        output_dir: Directory to save results to
+        **kwargs: Passed through to process_batch
+        
+    Returns:
+        Tuple of (total number of notes with staging information, batch numbers that failed)
+    """
+    if not batch_numbers:
+        return 0, []
+    if len(batch_numbers) == 1:
+        try:
+            return process_batch(batch_numbers[0], extractor, output_dir, **kwargs), []
+        except Exception as e:
+            logger.error(f"Error processing batch {batch_numbers[0]}: {e}")
+            return 0, batch_numbers
+    
+    patient_batching = kwargs.get("patient_batching", True)
+    
+    # spawn rather than fork: this process may already have CUDA initialized
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as prefetcher:
+        prefetch_broken = False
+        
+        def prefetch(batch_number: int):
+            nonlocal prefetch_broken
+            input_file = INPUT_FILE_TEMPLATE.format(batch_number)
+            if prefetch_broken or not os.path.exists(input_file):
+                return None
+            try:
+                return prefetcher.submit(_read_candidates_worker, input_file, extractor.use_prefilter, patient_batching)
+            except BrokenProcessPool as e:
+                # The worker died (e.g. out of memory on a large file); process_batch reads files itself
+                logger.warning(f"Prefetch worker failed, reading the remaining batches directly: {e}")
+                prefetch_broken = True
+                return None
+        
+        total = 0
+        failed = []
+        next_future = prefetch(batch_numbers[0])
+        for i, batch_number in enumerate(batch_numbers):
+            future = next_future
+            next_future = prefetch(batch_numbers[i + 1]) if i + 1 < len(batch_numbers) else None
+            
+            candidates = None
+            if future is not None:
+                try:
+                    candidates = future.result()
+                except Exception as e:
+                    logger.warning(f"Prefetching batch {batch_number} failed, reading it directly: {e}")
+            
+            try:
+                count = process_batch(batch_number, extractor, output_dir, candidates=candidates, **kwargs)
+            except Exception as e:
+                logger.error(f"Error processing batch {batch_number}: {e}")
+                failed.append(batch_number)
+                continue
+            logger.info(f"Batch {batch_number} complete: {count} notes with staging information")
+            total += count
+    
+    return total, failed
+
+def _process_batch_worker(batch_number: int, output_dir: str, extractor_options: Dict, **kwargs) -> int:
+    """
+    Process one batch in a worker process with its own (server-backed) extractor.
+    
+    Args:
+        batch_number: Batch number to process
+        output_dir: Directory to save results to
+        extractor_options: StagingExtractor attributes to set, e.g. server_url
+        **kwargs: Passed through to process_batch
+        
+    Returns:
+        Number of notes with staging information
+    """
+    extractor = StagingExtractor()
+    for name, value in extractor_options.items():
+        setattr(extractor, name, value)
+    return process_batch(batch_number, extractor, output_dir, **kwargs)
+
+def process_batches_concurrently(batch_numbers: List[int], output_dir: str, extractor_options: Dict,
+                                 max_workers: int, **kwargs) -> Tuple[int, List[int]]:
+    """
+    Process batch files in a pool of worker processes that share one vLLM server.
+    
+    Parquet reading, pre-filtering and pandas work run in parallel across CPU
+    cores, while each worker sends its prompts to the server concurrently so
+    the GPU stays saturated.
+    
+    Args:
+        batch_numbers: Batch numbers to process
+        output_dir: Directory to save results to
+        extractor_options: StagingExtractor attributes to set in each worker; must include server_url
+        max_workers: Number of worker processes
+        **kwargs: Passed through to process_batch
+        
+    Returns:
+        Tuple of (total number of notes with staging information, batch numbers that failed)
+    """
+    total = 0
+    failed = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_process_batch_worker, batch_number, output_dir, extractor_options, **kwargs): batch_number
+            for batch_number in batch_numbers
+        }
+        for future in as_completed(futures):
+            batch_number = futures[future]
+            try:
+                count = future.result()
+                logger.info(f"Batch {batch_number} complete: {count} notes with staging information")
+                total += count
+            except Exception as e:
+                logger.error(f"Error processing batch {batch_number}: {e}")
+                failed.append(batch_number)
+    return total, sorted(failed)
+
+def parse_batch_numbers(values: List[str]) -> List[int]:
+    """
+    Expand batch arguments such as "5" and "0-99" (inclusive) into batch numbers.
+    
+    Args:
+        values: Batch numbers and/or ranges
+        
+    Returns:
+        List of batch numbers in the order given
+    """
+    batch_numbers = []
+    for value in values:
+        start, sep, end = value.partition("-")
+        if sep:
+            if int(end) < int(start):
+                raise ValueError(f"range {value} ends before it starts")
+            batch_numbers.extend(range(int(start), int(end) + 1))
+        else:
+            batch_numbers.append(int(value))
+    return batch_numbers
+
 def main():
     """Main function to run the staging extraction pipeline."""
     # Configure argument parser
-    parser = argparse.ArgumentParser(description='Process a single batch of clinical notes')
-    parser.add_argument('batch_number', type=int, help='Batch number to process')
+    parser = argparse.ArgumentParser(description='Process batches of clinical notes')
+    parser.add_argument('batches', nargs='*', metavar='batch',
+                        help='Batch numbers and/or inclusive ranges to process, e.g. 5 or 0-99')
     parser.add_argument('--no-patient-batching', action='store_true', 
                         help='Disable patient-based batching and process each note individually')
     parser.add_argument('--test', action='store_true', help='Run test of parsing logic')
     parser.add_argument('--benchmark', action='store_true', help='Run benchmark of parsing performance')
+    parser.add_argument('--quantize', action='store_true',
+                        help='Quantize the model to INT4 AWQ (one-time setup) and exit; downloads calibration '
+                             'data from the Hugging Face Hub unless --calib-file is given')
+    parser.add_argument('--calib-file', metavar='PATH',
+                        help='Local calibration text for --quantize, one sample per line (for offline nodes)')
+    parser.add_argument('--full-precision', action='store_true',
+                        help='Load the FP16 model even if a quantized checkpoint exists')
+    parser.add_argument('--no-prefilter', action='store_true',
+                        help='Send full note text to the LLM instead of regex-matched staging windows')
+    parser.add_argument('--output-columns', nargs='+', metavar='COLUMN',
+                        help='Only write these input columns besides patientdurablekey and note_text '
+                             '(default: all input columns)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Ignore and do not update the staging_cache.pkl results cache')
+    parser.add_argument('--server-url', metavar='URL',
+                        help='Send prompts to a running vLLM OpenAI-compatible server (e.g. http://localhost:8000/v1) '
+                             'instead of loading the model in this process')
+    parser.add_argument('--compile', action='store_true',
+                        help='Use a static KV cache and torch.compile with the transformers backend')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Worker processes for concurrent batch processing with --server-url (default: CPU count)')
+    parser.add_argument('--server-concurrency', type=int, default=256,
+                        help='Total in-flight requests to the --server-url server, split across workers '
+                             '(default: 256, the --max-num-seqs of run_vllm_server.sh)')
     args = parser.parse_args()
     
     # Handle test and benchmark modes
@@ -667,62 +1532,68 @@ def main():
         benchmark_parsing()
         return
     
+    if args.quantize:
+        extractor = StagingExtractor()
+        quantize_model(extractor.model_path, extractor.quantized_model_path, args.calib_file)
+        return
+    
+    if not args.batches:
+        parser.error("batch is required unless --test, --benchmark or --quantize is given")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.server_concurrency < 1:
+        parser.error("--server-concurrency must be at least 1")
+    try:
+        batch_numbers = parse_batch_numbers(args.batches)
+    except ValueError as e:
+        parser.error(f"invalid batch number or range in: {' '.join(args.batches)} ({e})")
+    
     # Configure paths
-    input_file = f"/wynton/protected/home/zack/brtan/Stage_2_Staging_Extractor/data/output/filtered_notes/final/filtered_notes_batch_{args.batch_number}.parquet"
-    output_dir = "/wynton/protected/home/zack/brtan/Stage_2_Staging_Extractor/data/output/staging_results"
+    output_dir = OUTPUT_DIR
     
     # Ensure output directory exists
     os.makedirs(output_dir, exist_ok=True)
     
     logger.info(f"Starting staging extraction pipeline")
-    logger.info(f"Input file: {input_file}")
+    logger.info(f"Batches: {batch_numbers}")
     logger.info(f"Output directory: {output_dir}")
     logger.info(f"Patient-based batching: {'disabled' if args.no_patient_batching else 'enabled'}")
+    logger.info(f"Regex pre-filter: {'disabled' if args.no_prefilter else 'enabled'}")
     
-    # Check if input file exists
-    if not os.path.exists(input_file):
-        logger.error(f"Input file not found: {input_file}")
-        return
+    extractor_options = {
+        "use_quantized": not args.full_precision,
+        "use_prefilter": not args.no_prefilter,
+        "server_url": args.server_url,
+        "server_concurrency": args.server_concurrency,
+        "compile_model": args.compile,
+    }
+    batch_options = {
+        "use_cache": not args.no_cache,
+        "patient_batching": not args.no_patient_batching,
+        "output_columns": args.output_columns,
+    }
     
-    # Initialize the staging extractor
-    extractor = StagingExtractor()
-    
-    # Process the file
-    if args.no_patient_batching:
-        # Force individual note processing by removing patientdurablekey column if it exists
-        df = pd.read_parquet(input_file)
-        if 'patientdurablekey' in df.columns:
-            df = df.drop(columns=['patientdurablekey'])
-        
-        # Save to a temporary file
-        temp_file = input_file.replace('.parquet', '_temp.parquet')
-        df.to_parquet(temp_file)
-        
-        # Process the temporary file
-        result_df = process_file(temp_file, extractor)
-        
-        # Remove temporary file
-        try:
-            os.remove(temp_file)
-        except Exception as e:
-            logger.warning(f"Failed to remove temporary file {temp_file}: {e}")
-    else:
-        # Process with patient-based batching
-        result_df = process_file(input_file, extractor)
-    
-    if not result_df.empty:
-        # Save results
-        output_file = os.path.join(output_dir, f"staging_results_batch_{args.batch_number}.parquet")
-        result_df.to_parquet(output_file, index=False)
-        logger.info(f"Saved results to {output_file}")
-        
-        # Also save as CSV for easier inspection
-        csv_file = os.path.join(output_dir, f"staging_results_batch_{args.batch_number}.csv")
-        result_df.to_csv(csv_file, index=False)
-        logger.info(f"Also saved as CSV to {csv_file}")
-        logger.info(f"Total notes with staging information: {len(result_df)}")
+    if args.server_url and len(batch_numbers) > 1:
+        # Lightweight client workers share the server; model load is paid once by the server.
+        # The total number of in-flight requests is bounded so none wait out the read timeout
+        # in the server's queue.
+        workers = min(args.workers, len(batch_numbers), args.server_concurrency)
+        extractor_options["server_concurrency"] = max(1, args.server_concurrency // workers)
+        logger.info(f"Processing {len(batch_numbers)} batches with {workers} workers via {args.server_url} "
+                    f"({extractor_options['server_concurrency']} requests in flight per worker)")
+        total, failed = process_batches_concurrently(batch_numbers, output_dir, extractor_options, workers, **batch_options)
     else:
-        logger.info("No staging information found in the file")
+        # Initialize the staging extractor once and reuse it (and the loaded model) for every batch
+        extractor = StagingExtractor()
+        for name, value in extractor_options.items():
+            setattr(extractor, name, value)
+        extractor._load_llm()
+        total, failed = process_batches_sequentially(batch_numbers, extractor, output_dir, **batch_options)
+    
+    logger.info(f"Total notes with staging information across all batches: {total}")
+    if failed:
+        logger.error(f"{len(failed)} batches failed and have no results: {failed}")
+        sys.exit(1)
 
 if __name__ == "__main__":
     # Normal execution
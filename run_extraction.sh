@@ -4,15 +4,18 @@
 
 # Display usage information
 if [ "$1" == "--help" ] || [ "$1" == "-h" ]; then
-    echo "Usage: ./run_extraction.sh [OPTION] BATCH_NUMBER"
+    echo "Usage: ./run_extraction.sh [OPTION] BATCH_NUMBER [BATCH_NUMBER ...]"
     echo ""
     echo "Options:"
     echo "  --test         Run the parsing logic tests"
     echo "  --benchmark    Run the parsing performance benchmark"
+    echo "  --quantize     Quantize the model to INT4 AWQ (one-time setup; needs network"
+    echo "                 access unless --calib-file PATH gives local calibration text)"
     echo "  --help, -h     Display this help message"
     echo ""
     echo "Example:"
     echo "  ./run_extraction.sh 5         # Process batch 5"
+    echo "  ./run_extraction.sh 0-99      # Process batches 0 to 99, loading the model once"
     echo "  ./run_extraction.sh --test    # Run tests"
     exit 0
 fi
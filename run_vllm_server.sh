@@ -0,0 +1,48 @@
+#!/bin/bash
+# Start a vLLM OpenAI-compatible server for the local Llama-3.1-8B model.
+# Extraction clients connect with: python new_extract_staging.py <batches...> --server-url http://localhost:8000/v1
+
+# Display usage information
+if [ "$1" == "--help" ] || [ "$1" == "-h" ]; then
+    echo "Usage: ./run_vllm_server.sh [PORT]"
+    echo ""
+    echo "Starts the vLLM server on PORT (default: 8000)."
+    echo "The INT4 AWQ checkpoint (<model>-awq) is used if it exists."
+    exit 0
+fi
+
+PORT=${1:-8000}
+
+# Activate the virtual environment
+echo "Activating virtual environment..."
+source /wynton/protected/home/zack/brtan/Virtual_Environments/dask_distribution_env/bin/activate
+
+# Check if activation was successful
+if [ $? -ne 0 ]; then
+    echo "Error: Failed to activate virtual environment"
+    exit 1
+fi
+
+# Verify model path exists, preferring the quantized checkpoint
+MODEL_PATH="/wynton/protected/home/zack/brtan/models/Llama-3.1-8B"
+if [ -d "${MODEL_PATH}-awq" ]; then
+    echo "Using quantized model at: ${MODEL_PATH}-awq"
+    MODEL_ARGS="--model ${MODEL_PATH}-awq --quantization awq --dtype float16"
+elif [ -d "$MODEL_PATH" ]; then
+    echo "Using local model at: $MODEL_PATH"
+    MODEL_ARGS="--model $MODEL_PATH --dtype bfloat16"
+else
+    echo "Error: Model path not found: $MODEL_PATH"
+    deactivate
+    exit 1
+fi
+
+# --max-num-seqs bounds the number of sequences batched together on the GPU
+python -m vllm.entrypoints.openai.api_server \
+    $MODEL_ARGS \
+    --tokenizer "$MODEL_PATH" \
+    --served-model-name llama-3.1-8b \
+    --max-model-len 8192 \
+    --max-num-seqs 256 \
+    --gpu-memory-utilization 0.9 \
+    --port "$PORT"